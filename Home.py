@@ -14,6 +14,7 @@ st.markdown("""
 
 - **🧾 レシート登録**: AIを使ってレシートを解析し、スプレッドシートに保存します（一括・分割対応）。
 - **📊 資産分析**: 保存されたデータを読み込み、25日締めで集計・グラフ化します。
+- **📈 推移分析**: 全期間の月次推移・移動平均・収入/支出/資産の推移を表示します。
 
 現在、認証済みです。
 """)
\ No newline at end of file
@@ -0,0 +1,168 @@
+"""金融機関CSVのコマンドライン一括取込 (Streamlit不要)
+
+使い方:
+    python ingest.py ~/Downloads --institution Rカード --dry-run
+    python ingest.py ~/Downloads --config .streamlit/secrets.toml --workers 4
+
+設定は TOML ファイル (Streamlit の secrets.toml と同じキー。既定はこのスクリプトと同じ
+ディレクトリの .streamlit/secrets.toml) と環境変数から読み込む。
+環境変数が優先される:
+    SPREADSHEET_ID              取込先スプレッドシートID
+    GCP_SERVICE_ACCOUNT_FILE    サービスアカウントのJSONキーファイル
+    INGEST_INSTITUTION          金融機関名 (省略時はCSVヘッダーから推定)
+    INGEST_MEMBER               デフォルトの対象者
+    INGEST_WORKERS              並列数
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+import sheets_limiter as sl
+from ledger_core import (
+    JST, INSTITUTION_CONFIG,
+    authorize_client, read_category_master, parse_institution_csv,
+    detect_institution, plan_bulk_rows, invalidate_ledger_cache,
+)
+
+# cron など別ディレクトリから実行しても見つかるよう、このスクリプトの場所を基準にする
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".streamlit", "secrets.toml")
+REQUIRED_CONFIG_KEYS = ("SPREADSHEET_ID", "gcp_service_account")
+DEFAULT_MEMBER = "共通"
+DEFAULT_WORKERS = 4
+
+
+def load_config(config_path=None):
+    config = {}
+    path = config_path or DEFAULT_CONFIG_PATH
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    elif config_path:
+        raise FileNotFoundError(f"設定ファイルが見つかりません: {config_path}")
+
+    if os.environ.get("SPREADSHEET_ID"):
+        config["SPREADSHEET_ID"] = os.environ["SPREADSHEET_ID"]
+    if os.environ.get("GCP_SERVICE_ACCOUNT_FILE"):
+        with open(os.environ["GCP_SERVICE_ACCOUNT_FILE"], encoding="utf-8") as f:
+            config["gcp_service_account"] = json.load(f)
+    for key in ("INGEST_INSTITUTION", "INGEST_MEMBER", "INGEST_WORKERS"):
+        if os.environ.get(key):
+            config[key] = os.environ[key]
+    return config
+
+
+def parse_file(path, institution_name, default_member, master_dict):
+    """1ファイルを解析する。戻り値: (ファイル名, 金融機関名, 行リスト, メッセージリスト)"""
+    filename = os.path.basename(path)
+    with open(path, "rb") as f:
+        file_obj = io.BytesIO(f.read())
+
+    inst = institution_name or detect_institution(file_obj)
+    if inst is None:
+        return filename, None, [], [f"⚠️ {filename}: 金融機関を判定できないためスキップ"]
+    try:
+        rows, warnings = parse_institution_csv(file_obj, filename, inst, default_member, master_dict)
+    except Exception as e:
+        return filename, inst, [], [f"❌ {filename}: 処理エラー - {e}"]
+    return filename, inst, rows, warnings
+
+
+def sync_group(client, spreadsheet_id, institution_name, rows, dry_run):
+    """金融機関ごとに既存データと照合し、新規行を追記する。戻り値: (追記行リスト, スキップ数)"""
+    sheet_name = INSTITUTION_CONFIG[institution_name]["sheet_name"]
+    sheet = sl.open_worksheet(client, spreadsheet_id, sheet_name)
+    existing_data = sl.get_all_values(sheet)
+    df_to_save = pd.DataFrame(rows).sort_values(by="date")
+    now_jst = datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')
+    rows_to_append, skipped_count = plan_bulk_rows(df_to_save, existing_data, institution_name, now_jst)
+
+    if rows_to_append and not dry_run:
+        sl.append_rows(sheet, rows_to_append)
+        invalidate_ledger_cache(sheet_name)
+    return rows_to_append, skipped_count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="金融機関CSVをスプレッドシートに一括登録する")
+    parser.add_argument("directory", help="CSVファイルのあるディレクトリ")
+    parser.add_argument("--config", help=f"設定ファイル (既定: {DEFAULT_CONFIG_PATH})")
+    parser.add_argument("--institution", choices=list(INSTITUTION_CONFIG.keys()),
+                        help="金融機関 (省略時はCSVヘッダーから推定)")
+    parser.add_argument("--member", help="デフォルトの対象者")
+    parser.add_argument("--workers", type=int, help="並列数")
+    parser.add_argument("--dry-run", action="store_true", help="登録せずに追加予定の行を表示する")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        parser.error(f"設定の読み込みに失敗しました: {e}")
+    missing = [key for key in REQUIRED_CONFIG_KEYS if key not in config]
+    if missing:
+        parser.error(f"設定エラー: {', '.join(missing)} がありません (--config または環境変数で指定)")
+    institution_name = args.institution or config.get("INGEST_INSTITUTION")
+    if institution_name and institution_name not in INSTITUTION_CONFIG:
+        parser.error(f"未対応の金融機関です: {institution_name}")
+    default_member = args.member or config.get("INGEST_MEMBER", DEFAULT_MEMBER)
+    workers = args.workers or int(config.get("INGEST_WORKERS", DEFAULT_WORKERS))
+
+    paths = sorted(
+        os.path.join(args.directory, name) for name in os.listdir(args.directory)
+        if name.lower().endswith(".csv")
+    )
+    if not paths:
+        print("CSVファイルが見つかりません。")
+        return 0
+
+    client = authorize_client(config["gcp_service_account"])
+    spreadsheet_id = config["SPREADSHEET_ID"]
+    master_dict = read_category_master(client, spreadsheet_id)
+    has_error = False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda p: parse_file(p, institution_name, default_member, master_dict), paths
+        ))
+
+        groups = {}
+        for filename, inst, rows, messages in results:
+            for msg in messages:
+                print(msg)
+                if msg.startswith("❌"): has_error = True
+            if rows:
+                groups.setdefault(inst, []).extend(rows)
+                print(f"{filename}: {inst} {len(rows)} 件")
+
+        futures = {
+            inst: executor.submit(sync_group, client, spreadsheet_id, inst, rows, args.dry_run)
+            for inst, rows in groups.items()
+        }
+
+    for inst, future in futures.items():
+        sheet_name = INSTITUTION_CONFIG[inst]["sheet_name"]
+        try:
+            rows_to_append, skipped_count = future.result()
+        except Exception as e:
+            print(f"❌ {inst} ({sheet_name}): 登録エラー - {e}")
+            has_error = True
+            continue
+
+        if args.dry_run:
+            print(f"--- {sheet_name} ({inst}): 追加予定 {len(rows_to_append)} 件 / 重複 {skipped_count} 件")
+            for row in rows_to_append:
+                print("+ " + "\t".join(str(v) for v in row))
+        else:
+            print(f"✅ {sheet_name} ({inst}): {len(rows_to_append)} 件を新規登録 / {skipped_count} 件は重複のためスキップ")
+
+    return 1 if has_error else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
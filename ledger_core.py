@@ -0,0 +1,379 @@
+import pandas as pd
+import io
+import os
+import re
+import time
+import unicodedata
+from difflib import SequenceMatcher
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+from datetime import date, datetime, timedelta, timezone
+import sheets_limiter as sl
+
+# Streamlitに依存しない共通ロジック (画面: utils.py / コマンドライン: ingest.py から利用)
+
+JST = timezone(timedelta(hours=9), 'JST')
+MASTER_SHEET_NAME = "Category_Master"
+# 起動ディレクトリに依存しないよう、このモジュールの場所を基準にする (画面とingest.pyで共有)
+LEDGER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".ledger_cache")
+LEDGER_CACHE_MAX_AGE_MINUTES = 10
+DUPLICATE_DATE_WINDOW_DAYS = 3
+DUPLICATE_MIN_SCORE = 0.5
+GSPREAD_SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+# --- 金融機関ごとの設定 ---
+# 文字コードは cp932 (Windows Shift-JIS) に統一
+INSTITUTION_CONFIG = {
+    "M銀行": {
+        "sheet_name": "Bank_DB", "encoding": "cp932",
+        "date_col": "年月日", "store_col": "お取り扱い内容",
+        "expense_col": "お引出し", "income_col": "お預入れ", "balance_col": "残高"
+    },
+    "Rカード": {
+        "sheet_name": "Credit_DB", "encoding": "cp932",
+        "date_col": "利用日", "store_col": "利用店名・商品名",
+        "amount_col": "支払総額", "member_col": "利用者"
+    },
+    "R証券": {
+        "sheet_name": "Securities_DB", "encoding": "cp932",
+        "custom_loader": "rakuten_sec_balance"
+    },
+    "Y銀行": { "sheet_name": "Bank_DB", "date_col": "取引日", "store_col": "お取引内容", "amount_col": "出金金額", "encoding": "cp932" },
+    "Iクレ": { "sheet_name": "Credit_DB", "date_col": "利用日", "store_col": "加盟店名", "amount_col": "利用金額", "encoding": "cp932" }
+}
+
+def authorize_client(creds_dict):
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(dict(creds_dict), GSPREAD_SCOPE)
+    return gspread.authorize(creds)
+
+# --- 特殊CSV読み込み機能 ---
+
+def extract_date_from_filename(filename):
+    if not filename: return None
+    match = re.search(r'(\d{8})', filename)
+    if match:
+        try:
+            return datetime.strptime(match.group(1), '%Y%m%d').date()
+        except:
+            return None
+    return None
+
+def load_rakuten_securities_csv(file_obj, encoding="cp932"):
+    try:
+        content = file_obj.getvalue().decode(encoding)
+        lines = content.splitlines()
+        start_row = 0
+        found = False
+        for i, line in enumerate(lines):
+            if "■ 保有商品詳細" in line:
+                start_row = i + 2
+                found = True
+                break
+        if not found: start_row = 0
+        csv_io = io.StringIO("\n".join(lines[start_row:]))
+        df = pd.read_csv(csv_io)
+        return df
+    except Exception as e:
+        print(f"Read Error: {e}")
+        return None
+
+# --- カテゴリマスタ機能 ---
+
+def read_category_master(client, spreadsheet_id):
+    try:
+        sheet = sl.open_worksheet(client, spreadsheet_id, MASTER_SHEET_NAME)
+        data = sl.get_all_values(sheet)
+        if len(data) <= 1: return {}
+        return {row[0]: row[1] for row in data[1:] if row[0]}
+    except:
+        return {}
+
+def normalize_text(text):
+    if not isinstance(text, str): return str(text)
+    normalized = unicodedata.normalize('NFKC', text)
+    return normalized.replace(" ", "").replace("　", "")
+
+def suggest_category(store_name, master_dict):
+    if not store_name: return "未分類"
+    target_store = normalize_text(store_name)
+    for keyword, category in master_dict.items():
+        if normalize_text(keyword) in target_store:
+            return category
+    return "未分類"
+
+# --- CSV解析 ---
+
+def parse_institution_csv(file_obj, filename, institution_name, default_member, master_dict):
+    """金融機関CSVを登録用の行リストに変換する。戻り値: (行リスト, 警告メッセージリスト)"""
+    config = INSTITUTION_CONFIG[institution_name]
+    rows = []
+    warnings = []
+    df = pd.DataFrame()
+
+    # --- A. 特殊ローダー ---
+    if "custom_loader" in config:
+        if config["custom_loader"] == "rakuten_sec_balance":
+            df = load_rakuten_securities_csv(file_obj, config["encoding"])
+            if df is not None:
+                target_date = extract_date_from_filename(filename)
+                if not target_date:
+                    warnings.append(f"⚠️ {filename}: 日付不明のため本日の日付を使用")
+                    target_date = date.today()
+                df["entry_date"] = target_date
+
+    # --- B. 通常ローダー ---
+    else:
+        df = pd.read_csv(file_obj, encoding=config["encoding"])
+
+    if df is None or df.empty: return rows, warnings
+
+    # --- データ整形 ---
+    # 1. R証券
+    if "custom_loader" in config and config["custom_loader"] == "rakuten_sec_balance":
+        type_col = "種別"
+        name_col = "銘柄"
+        val_col = "時価評価額[円]"
+        if name_col not in df.columns and "銘柄コード・ティッカー" in df.columns:
+            name_col = "銘柄コード・ティッカー"
+
+        if val_col in df.columns:
+            for _, row in df.iterrows():
+                val_str = str(row.get(val_col, "0")).replace(',', '').replace('円', '')
+                try: amount_val = int(float(val_str))
+                except: amount_val = 0
+
+                if amount_val > 0:
+                    rows.append({
+                        "date": row["entry_date"],
+                        "store": row.get(name_col, ""),
+                        "category_1": "資産",
+                        "category_2": row.get(type_col, "その他"),
+                        "amount": amount_val,
+                        "member": default_member,
+                        "institution": institution_name,
+                        "balance": None # 残高列は空
+                    })
+
+    # 2. Rカード (利用者列対応)
+    elif "member_col" in config:
+        for _, row in df.iterrows():
+            date_val = pd.to_datetime(row[config["date_col"]], errors='coerce').date()
+            if pd.isna(date_val): continue
+
+            store_val = str(row[config["store_col"]]).strip()
+
+            amt_str = str(row[config["amount_col"]]).replace(',', '').replace('円', '')
+            try: amount_val = int(float(amt_str))
+            except: continue
+
+            csv_member = str(row[config["member_col"]]).strip()
+            member_val = csv_member if csv_member else default_member
+            suggested_cat = suggest_category(store_val, master_dict)
+
+            rows.append({
+                "date": date_val,
+                "store": store_val,
+                "category_1": "支出",
+                "category_2": suggested_cat,
+                "amount": amount_val,
+                "member": member_val,
+                "institution": institution_name,
+                "balance": ""
+            })
+
+    # 3. その他銀行
+    else:
+        is_2col = ("expense_col" in config)
+        for _, row in df.iterrows():
+            date_val = pd.to_datetime(row[config["date_col"]], errors='coerce').date()
+            if pd.isna(date_val): continue
+            store_val = str(row[config["store_col"]]).strip() if pd.notna(row[config["store_col"]]) else ""
+
+            bal_val = ""
+            if "balance_col" in config and config["balance_col"] in df.columns:
+                b_str = str(row[config["balance_col"]]).replace(',', '')
+                try: bal_val = int(float(b_str))
+                except: pass
+
+            amt = 0
+            cat1 = "支出"
+            if is_2col:
+                e_str = str(row[config["expense_col"]]).replace(',', '')
+                i_str = str(row[config["income_col"]]).replace(',', '')
+                e_amt = int(float(e_str)) if e_str and e_str!='nan' else 0
+                i_amt = int(float(i_str)) if i_str and i_str!='nan' else 0
+                if e_amt > 0: amt, cat1 = e_amt, "支出"
+                elif i_amt > 0: amt, cat1 = i_amt, "収入"
+            else:
+                a_str = str(row[config["amount_col"]]).replace(',', '')
+                raw_amt = int(float(a_str)) if a_str and a_str!='nan' else 0
+                amt = abs(raw_amt)
+                cat1 = "支出" if raw_amt < 0 else "収入"
+
+            if amt > 0:
+                suggested_cat = suggest_category(store_val, master_dict)
+                if cat1 == "収入" and suggested_cat == "未分類": suggested_cat = "その他"
+
+                rows.append({
+                    "date": date_val,
+                    "store": store_val,
+                    "category_1": cat1,
+                    "category_2": suggested_cat,
+                    "amount": amt,
+                    "member": default_member,
+                    "institution": institution_name,
+                    "balance": bal_val
+                })
+
+    return rows, warnings
+
+def detect_institution(file_obj):
+    """CSVのヘッダー列から金融機関を推定する (特殊ローダーの金融機関は対象外)"""
+    for name, config in INSTITUTION_CONFIG.items():
+        if "custom_loader" in config: continue
+        required = [config[k] for k in ("date_col", "store_col", "amount_col", "expense_col") if k in config]
+        try:
+            file_obj.seek(0)
+            header = pd.read_csv(file_obj, encoding=config["encoding"], nrows=0).columns
+        except Exception:
+            continue
+        finally:
+            file_obj.seek(0)
+        if all(col in header for col in required):
+            return name
+    return None
+
+# --- 重複チェック ---
+
+def build_existing_signatures(existing_data):
+    existing_signatures = set()
+    if len(existing_data) > 1:
+        for row in existing_data[1:]:
+            if len(row) < 7: continue
+            amount_clean = str(row[4]).replace(',', '').replace('円', '')
+            inst_val = str(row[7]) if len(row) > 7 else ""
+            balance_val = str(row[8]) if len(row) > 8 else ""
+            balance_clean = balance_val.replace(',', '').replace('円', '')
+            signature = (
+                str(row[0]), str(row[1]), str(row[2]),
+                amount_clean, str(row[6]), inst_val, balance_clean
+            )
+            existing_signatures.add(signature)
+    return existing_signatures
+
+def plan_bulk_rows(df_to_save, existing_data, institution_name, now_str):
+    """既存データと照合し、追記すべき行を返す。戻り値: (追記行リスト, スキップ数)"""
+    existing_signatures = build_existing_signatures(existing_data)
+    rows_to_append = []
+    skipped_count = 0
+
+    for _, row in df_to_save.iterrows():
+        raw_bal = row.get('balance', '')
+        bal_str = str(raw_bal).replace(',', '').replace('円', '').replace('nan', '').replace('None', '')
+        try:
+            if bal_str: bal_str = str(int(float(bal_str)))
+        except: pass
+
+        new_signature = (
+            str(row['date']), str(row['store']), str(row['category_1']),
+            str(row['amount']), str(row['member']), str(institution_name), bal_str
+        )
+
+        if new_signature not in existing_signatures:
+            rows_to_append.append([
+                str(row['date']), str(row['store']), str(row['category_1']),
+                str(row['category_2']), int(row['amount']), now_str,
+                str(row['member']), str(institution_name), bal_str
+            ])
+            existing_signatures.add(new_signature)
+        else:
+            skipped_count += 1
+
+    return rows_to_append, skipped_count
+
+# --- シート間の重複候補検出 (レシート登録 vs カード明細) ---
+
+def _strip_item_suffix(store):
+    # 分割登録の "店名 (商品名)" から店名部分を取り出す
+    return re.sub(r'\s*\(.*\)\s*$', '', str(store))
+
+def _store_key(store):
+    return normalize_text(_strip_item_suffix(store)).lower()
+
+def store_similarity(a, b):
+    a, b = _store_key(a), _store_key(b)
+    if not a or not b: return 0.0
+    if a in b or b in a: return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+def find_cross_duplicates(new_df, existing_df, date_window_days=DUPLICATE_DATE_WINDOW_DAYS, min_score=DUPLICATE_MIN_SCORE):
+    """金額一致・日付±N日でブロッキングし、店名の類似度が閾値以上の組を返す。
+
+    全組み合わせの比較は行わず、(金額, 日) をキーにした結合で候補を絞り込む。
+    existing_df 側は同日・同店名の行 (分割登録の明細) を合計した候補も加えるため、
+    レシート合計額のカード明細とも照合できる。existing_rows はその組に含まれる全行。
+    new_df / existing_df は date, store, amount 列を持つこと。
+    """
+    columns = ["new_index", "existing_index", "existing_rows", "new_date", "new_store",
+               "existing_date", "existing_store", "amount", "score"]
+    if new_df is None or existing_df is None or new_df.empty or existing_df.empty:
+        return pd.DataFrame(columns=columns)
+
+    def keyed(df):
+        out = pd.DataFrame({
+            "date": pd.to_datetime(df["date"], errors='coerce').dt.normalize(),
+            "store": df["store"].astype(str),
+            "amount": pd.to_numeric(df["amount"], errors='coerce'),
+        }, index=df.index).dropna(subset=["date", "amount"])
+        out["amount"] = out["amount"].astype('int64')
+        out["day"] = (out["date"] - pd.Timestamp("1970-01-01")).dt.days
+        return out.rename_axis("row").reset_index()
+
+    new_keyed = keyed(new_df)
+    existing_keyed = keyed(existing_df)
+    existing_keyed["rows"] = [(r,) for r in existing_keyed["row"]]
+
+    # 分割登録の明細を (日付, 店名) ごとに合計した候補
+    existing_keyed["store_key"] = existing_keyed["store"].map(_store_key)
+    grouped = existing_keyed.groupby(["day", "store_key"], sort=False).agg(
+        row=("row", "first"), rows=("row", tuple), date=("date", "first"),
+        store=("store", "first"), amount=("amount", "sum"), count=("row", "size"),
+    ).reset_index()
+    grouped = grouped[grouped["count"] > 1]
+    grouped["store"] = grouped["store"].map(_strip_item_suffix)
+    existing_keyed = pd.concat([existing_keyed, grouped.drop(columns="count")], ignore_index=True)
+
+    offsets = pd.DataFrame({"offset": range(-date_window_days, date_window_days + 1)})
+    expanded = new_keyed.merge(offsets, how="cross")
+    expanded["day"] = expanded["day"] + expanded["offset"]
+    pairs = expanded.merge(existing_keyed, on=["amount", "day"], suffixes=("_new", "_existing"))
+    if pairs.empty:
+        return pd.DataFrame(columns=columns)
+
+    pairs["score"] = [store_similarity(a, b) for a, b in zip(pairs["store_new"], pairs["store_existing"])]
+    pairs = pairs[pairs["score"] >= min_score]
+    result = pairs.rename(columns={
+        "row_new": "new_index", "row_existing": "existing_index", "rows": "existing_rows",
+        "date_new": "new_date", "store_new": "new_store",
+        "date_existing": "existing_date", "store_existing": "existing_store",
+    })[columns]
+    # 1つの明細につき最も類似度の高い候補のみ残す (同点なら分割明細の合計を優先)
+    result = result.assign(_group_size=result["existing_rows"].map(len))
+    result = result.sort_values(["score", "_group_size"], ascending=False).drop_duplicates("new_index")
+    return result.drop(columns="_group_size").reset_index(drop=True)
+
+# --- 台帳キャッシュ ---
+
+def ledger_cache_path(sheet_name):
+    return os.path.join(LEDGER_CACHE_DIR, f"{sheet_name}.parquet")
+
+def is_ledger_cache_fresh(sheet_name, max_age_minutes=LEDGER_CACHE_MAX_AGE_MINUTES):
+    """キャッシュが存在し、保存からmax_age_minutes以内ならTrue (シート上の直接編集に追従するため)"""
+    path = ledger_cache_path(sheet_name)
+    if not os.path.exists(path): return False
+    return time.time() - os.path.getmtime(path) < max_age_minutes * 60
+
+def invalidate_ledger_cache(sheet_name):
+    path = ledger_cache_path(sheet_name)
+    if os.path.exists(path):
+        os.remove(path)
@@ -17,6 +17,7 @@ if 'input_amount' not in st.session_state: st.session_state['input_amount'] = 0
 if 'input_category' not in st.session_state: st.session_state['input_category'] = "食費"
 if 'input_member' not in st.session_state: st.session_state['input_member'] = ""
 if 'split_data' not in st.session_state: st.session_state['split_data'] = None
+if 'split_draft_key' not in st.session_state: st.session_state['split_draft_key'] = None
 
 reg_mode = st.radio("登録モードを選択", ["1. 合計で登録 (一括)", "2. 明細ごとに登録 (分割)"])
 uploaded_file = st.file_uploader("レシート画像をアップロード", type=["jpg", "png", "jpeg"])
@@ -25,6 +26,19 @@ uploaded_file = st.file_uploader("レシート画像をアップロード", type
 if reg_mode == "2. 明細ごとに登録 (分割)":
     if uploaded_file is not None:
         st.image(uploaded_file, caption="アップロード画像", width=300)
+        draft_key = utils.draft_key(uploaded_file.getvalue())
+
+        # 別の画像に切り替わったら、前の画像の明細は破棄してその画像の下書きを探す
+        if st.session_state['split_draft_key'] != draft_key:
+            st.session_state['split_draft_key'] = draft_key
+            st.session_state['split_data'] = None
+
+        # 再読み込み後は保存済みの下書きから復元 (再解析不要)
+        if st.session_state['split_data'] is None:
+            draft_df = utils.load_draft("receipt", draft_key)
+            if draft_df is not None:
+                st.session_state['split_data'] = draft_df
+                st.info("💾 前回の編集内容を復元しました")
         
         if st.button("🤖 AI解析 (明細読み取り)"):
             with st.spinner("商品ごとの明細を読み取っています..."):
@@ -43,15 +57,17 @@ if reg_mode == "2. 明細ごとに登録 (分割)":
                         default_date = date.today()
 
                     store_val = result_json.get("store", "")
+                    # カテゴリはマスタ優先で判定し、不明な商品名のみAIに問い合わせる
+                    item_categories = utils.categorize_receipt_items(items)
                     
                     init_data = []
-                    for item in items:
+                    for item, item_cat in zip(items, item_categories):
                         init_data.append({
                             "利用日": default_date,
                             "店名": store_val,
                             "商品名(メモ)": item.get("name", ""),
                             "金額": item.get("amount", 0),
-                            "カテゴリ": "食費",
+                            "カテゴリ": item_cat,
                             "対象者": ""
                         })
                     
@@ -60,41 +76,58 @@ if reg_mode == "2. 明細ごとに登録 (分割)":
                         df_split["利用日"] = pd.to_datetime(df_split["利用日"]).dt.date
 
                     st.session_state['split_data'] = df_split
+                    utils.save_draft("receipt", draft_key, df_split, f"{store_val} ({uploaded_file.name})")
                 else:
                     st.error("明細読み取り失敗。合計モードを試してください。")
-        
-        if st.session_state['split_data'] is not None:
-            st.write("### 📝 明細の編集・登録")
-            
-            edited_df = st.data_editor(
-                st.session_state['split_data'],
-                num_rows="dynamic",
-                column_config={
-                    "利用日": st.column_config.DateColumn("日付", format="YYYY-MM-DD"),
-                    "カテゴリ": st.column_config.SelectboxColumn("カテゴリ", options=utils.CATEGORIES+["その他"], required=True),
-                    "対象者": st.column_config.SelectboxColumn("対象者", options=[""]+utils.MEMBERS, required=False),
-                    "金額": st.column_config.NumberColumn("金額", format="%d円")
-                },
-                hide_index=True
-            )
-            
-            if st.button("✅ 全て登録する"):
-                success_count = 0
-                for index, row in edited_df.iterrows():
-                    save_data = {
-                        "date": row["利用日"],
-                        "store": row["店名"] + " (" + row["商品名(メモ)"] + ")",
-                        "category": row["カテゴリ"],
-                        "amount": row["金額"],
-                        "member": row["対象者"] if row["対象者"] else ""
-                    }
-                    if utils.save_to_google_sheets(save_data):
-                        success_count += 1
-                
-                if success_count > 0:
-                    st.balloons()
-                    st.success(f"{success_count} 件登録しました！")
-                    st.session_state['split_data'] = None
+
+    elif st.session_state['split_data'] is None:
+        # 再読み込み後でも、アップロードし直さずに保存済みの下書きから再開できる
+        restore_key = utils.draft_restore_picker("receipt")
+        if restore_key:
+            st.session_state['split_draft_key'] = restore_key
+            st.session_state['split_data'] = utils.load_draft("receipt", restore_key)
+            st.rerun()
+
+    if st.session_state['split_data'] is not None:
+        st.write("### 📝 明細の編集・登録")
+
+        edited_df = st.data_editor(
+            st.session_state['split_data'],
+            num_rows="dynamic",
+            column_config={
+                "利用日": st.column_config.DateColumn("日付", format="YYYY-MM-DD"),
+                "カテゴリ": st.column_config.SelectboxColumn("カテゴリ", options=utils.CATEGORIES+["その他"], required=True),
+                "対象者": st.column_config.SelectboxColumn("対象者", options=[""]+utils.MEMBERS, required=False),
+                "金額": st.column_config.NumberColumn("金額", format="%d円")
+            },
+            hide_index=True
+        )
+        utils.checkpoint_draft("receipt", st.session_state['split_draft_key'], edited_df)
+
+        if st.button("✅ 全て登録する"):
+            success_count = 0
+            learned_items = {}
+            for index, row in edited_df.iterrows():
+                save_data = {
+                    "date": row["利用日"],
+                    "store": row["店名"] + " (" + row["商品名(メモ)"] + ")",
+                    "category": row["カテゴリ"],
+                    "amount": row["金額"],
+                    "member": row["対象者"] if row["対象者"] else ""
+                }
+                if utils.save_to_google_sheets(save_data):
+                    success_count += 1
+                    if row["商品名(メモ)"]:
+                        learned_items[row["商品名(メモ)"]] = row["カテゴリ"]
+
+            # 確定したカテゴリを商品名マスタに学習
+            utils.update_item_master(learned_items)
+
+            if success_count > 0:
+                st.balloons()
+                st.success(f"{success_count} 件登録しました！")
+                st.session_state['split_data'] = None
+                utils.delete_draft("receipt", st.session_state['split_draft_key'])
 
 # --- 一括モード ---
 else:
@@ -1,5 +1,4 @@
 import streamlit as st
-import pandas as pd
 import utils
 
 st.set_page_config(page_title="日常管理", layout="wide")
@@ -8,35 +7,27 @@ utils.check_password()
 st.title("📊 日常収支管理")
 
 # データ更新ボタン
-if st.button("データを更新"):
+refresh = st.button("データを更新")
+if refresh:
     st.cache_data.clear()
-    st.rerun()
 
-# データの読み込み
-df = utils.load_data_from_sheets()
+# データの読み込み (型変換済み・キャッシュがあれば即時復元)
+df = utils.load_typed_ledger(utils.LOG_SHEET_NAME, refresh=refresh)
 
 if df is not None and not df.empty:
     # --- データ前処理 ---
-    # 金額を数値に変換
-    df['amount'] = pd.to_numeric(
-        df['amount'].astype(str).str.replace(',', '').str.replace('円', ''), 
-        errors='coerce'
-    ).fillna(0).astype(int)
-
-    # 日付型へ変換
-    df['date'] = pd.to_datetime(df['date'], errors='coerce')
     df = df.dropna(subset=['date']) # 日付がない行は除外
 
     # 会計月（25日締め）カラムを作成
-    df['fiscal_month'] = df['date'].apply(utils.get_fiscal_month)
+    df['fiscal_month'] = utils.get_fiscal_months(df['date'])
 
     # メンバー情報の欠損埋め
     if 'member' not in df.columns:
         df['member'] = "共通"
-    df['member'] = df['member'].fillna("共通").replace("", "共通")
+    df['member'] = df['member'].astype(object).fillna("共通").replace("", "共通").astype('category')
 
     # 表示用カテゴリ作成（カテゴリ + 対象者）
-    df['display_category'] = df['category'] + " (" + df['member'] + ")"
+    df['display_category'] = df['category'].astype(str) + " (" + df['member'].astype(str) + ")"
 
     # --- 画面表示 ---
     
@@ -65,7 +56,7 @@ if df is not None and not df.empty:
     st.write("### 🥧 カテゴリ別支出構成")
     if not month_df.empty:
         # カテゴリ×対象者ごとの集計
-        chart_data = month_df.groupby(['category', 'member'])['amount'].sum().reset_index()
+        chart_data = month_df.groupby(['category', 'member'], observed=True)['amount'].sum().reset_index()
         
         # 棒グラフ（積み上げ）
         st.bar_chart(
@@ -1,7 +1,6 @@
 import streamlit as st
 import pandas as pd
 import utils
-from datetime import date
 
 st.set_page_config(page_title="CSV一括登録", layout="wide")
 utils.check_password()
@@ -23,8 +22,10 @@ with st.sidebar:
 st.markdown("各金融機関のCSVを取り込み、**収支区分(Cat1)** と **費目(Cat2)** に分けて登録します。")
 
 # 設定選択
+if 'csv_pending_institution' in st.session_state:
+    st.session_state['csv_institution'] = st.session_state.pop('csv_pending_institution')
 col1, col2 = st.columns(2)
-institution_name = col1.selectbox("🏦 金融機関を選択", list(utils.INSTITUTION_CONFIG.keys()))
+institution_name = col1.selectbox("🏦 金融機関を選択", list(utils.INSTITUTION_CONFIG.keys()), key="csv_institution")
 selected_member_default = col2.selectbox("👤 デフォルトの対象者", utils.MEMBERS, index=0)
 
 config = utils.INSTITUTION_CONFIG[institution_name]
@@ -40,139 +41,80 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
+draft_key = None
 if uploaded_files:
-    all_processed_rows = []
-    
-    for uploaded_file in uploaded_files:
-        try:
-            df = pd.DataFrame()
-            target_date = None
-            
-            # --- A. 特殊ローダー ---
-            if "custom_loader" in config:
-                if config["custom_loader"] == "rakuten_sec_balance":
-                    df = utils.load_rakuten_securities_csv(uploaded_file, config["encoding"])
-                    if df is not None:
-                        file_date = utils.extract_date_from_filename(uploaded_file.name)
-                        if file_date:
-                            target_date = file_date
-                        else:
-                            st.warning(f"⚠️ {uploaded_file.name}: 日付不明のため本日の日付を使用")
-                            target_date = date.today()
-                        df["entry_date"] = target_date
-
-            # --- B. 通常ローダー ---
-            else:
-                df = pd.read_csv(uploaded_file, encoding=config["encoding"])
-            
-            if df is None or df.empty: continue
-            
-            # --- データ整形 ---
-            # 1. R証券
-            if "custom_loader" in config and config["custom_loader"] == "rakuten_sec_balance":
-                type_col = "種別"
-                name_col = "銘柄"
-                val_col = "時価評価額[円]"
-                if name_col not in df.columns and "銘柄コード・ティッカー" in df.columns:
-                    name_col = "銘柄コード・ティッカー"
-                
-                if val_col in df.columns:
-                    for _, row in df.iterrows():
-                        val_str = str(row.get(val_col, "0")).replace(',', '').replace('円', '')
-                        try: amount_val = int(float(val_str))
-                        except: amount_val = 0
-                        
-                        if amount_val > 0:
-                            all_processed_rows.append({
-                                "date": row["entry_date"],
-                                "store": row.get(name_col, ""),
-                                "category_1": "資産",
-                                "category_2": row.get(type_col, "その他"),
-                                "amount": amount_val,
-                                "member": selected_member_default,
-                                "institution": institution_name,
-                                "balance": None # 残高列は空
-                            })
-
-            # 2. Rカード (利用者列対応)
-            elif "member_col" in config:
-                for _, row in df.iterrows():
-                    date_val = pd.to_datetime(row[config["date_col"]], errors='coerce').date()
-                    if pd.isna(date_val): continue
-                    
-                    store_val = str(row[config["store_col"]]).strip()
-                    
-                    amt_str = str(row[config["amount_col"]]).replace(',', '').replace('円', '')
-                    try: amount_val = int(float(amt_str))
-                    except: continue
-                    
-                    csv_member = str(row[config["member_col"]]).strip()
-                    member_val = csv_member if csv_member else selected_member_default
-                    suggested_cat = utils.suggest_category(store_val, master_dict)
-
-                    all_processed_rows.append({
-                        "date": date_val,
-                        "store": store_val,
-                        "category_1": "支出",
-                        "category_2": suggested_cat,
-                        "amount": amount_val,
-                        "member": member_val,
-                        "institution": institution_name,
-                        "balance": "" 
-                    })
-
-            # 3. その他銀行
-            else:
-                is_2col = ("expense_col" in config)
-                for _, row in df.iterrows():
-                    date_val = pd.to_datetime(row[config["date_col"]], errors='coerce').date()
-                    if pd.isna(date_val): continue
-                    store_val = str(row[config["store_col"]]).strip() if pd.notna(row[config["store_col"]]) else ""
-                    
-                    bal_val = ""
-                    if "balance_col" in config and config["balance_col"] in df.columns:
-                        b_str = str(row[config["balance_col"]]).replace(',', '')
-                        try: bal_val = int(float(b_str))
-                        except: pass
-                    
-                    amt = 0
-                    cat1 = "支出"
-                    if is_2col:
-                        e_str = str(row[config["expense_col"]]).replace(',', '')
-                        i_str = str(row[config["income_col"]]).replace(',', '')
-                        e_amt = int(float(e_str)) if e_str and e_str!='nan' else 0
-                        i_amt = int(float(i_str)) if i_str and i_str!='nan' else 0
-                        if e_amt > 0: amt, cat1 = e_amt, "支出"
-                        elif i_amt > 0: amt, cat1 = i_amt, "収入"
-                    else:
-                        a_str = str(row[config["amount_col"]]).replace(',', '')
-                        raw_amt = int(float(a_str)) if a_str and a_str!='nan' else 0
-                        amt = abs(raw_amt)
-                        cat1 = "支出" if raw_amt < 0 else "収入"
-                    
-                    if amt > 0:
-                        suggested_cat = utils.suggest_category(store_val, master_dict)
-                        if cat1 == "収入" and suggested_cat == "未分類": suggested_cat = "その他"
-
-                        all_processed_rows.append({
-                            "date": date_val,
-                            "store": store_val,
-                            "category_1": cat1,
-                            "category_2": suggested_cat,
-                            "amount": amt,
-                            "member": selected_member_default,
-                            "institution": institution_name,
-                            "balance": bal_val
-                        })
-
-        except Exception as e:
-            st.error(f"❌ {uploaded_file.name}: 処理エラー - {e}")
+    st.session_state['csv_restored_key'] = None
+    draft_key = utils.draft_key(
+        institution_name, selected_member_default, *[f.getvalue() for f in uploaded_files]
+    )
+    base_state_key = f"import_base_{draft_key}"
+
+    if base_state_key not in st.session_state:
+        # 再読み込み後は保存済みの下書きから復元 (再解析不要)
+        import_df = utils.load_draft("csv", draft_key)
+        if import_df is not None:
+            st.info("💾 前回の編集内容を復元しました")
+        else:
+            all_processed_rows = []
+
+            for uploaded_file in uploaded_files:
+                try:
+                    rows, warnings = utils.parse_institution_csv(
+                        uploaded_file, uploaded_file.name, institution_name, selected_member_default, master_dict
+                    )
+                    for w in warnings:
+                        st.warning(w)
+                    all_processed_rows.extend(rows)
+
+                except Exception as e:
+                    st.error(f"❌ {uploaded_file.name}: 処理エラー - {e}")
+
+            if all_processed_rows:
+                import_df = pd.DataFrame(all_processed_rows).sort_values(by="date")
+                draft_label = f"{institution_name} / " + ", ".join(f.name for f in uploaded_files)
+                utils.save_draft("csv", draft_key, import_df, draft_label)
+        st.session_state[base_state_key] = import_df
+else:
+    draft_key = st.session_state.get('csv_restored_key')
+    if draft_key is None:
+        # 再読み込み後でも、アップロードし直さずに保存済みの下書きから再開できる
+        restore_key = utils.draft_restore_picker("csv")
+        if restore_key:
+            restored_df = utils.load_draft("csv", restore_key)
+            if restored_df is not None:
+                st.session_state['csv_restored_key'] = restore_key
+                st.session_state[f"import_base_{restore_key}"] = restored_df
+                if not restored_df.empty:
+                    # ウィジェット生成後は値を変更できないため、次回実行の先頭で反映する
+                    st.session_state['csv_pending_institution'] = restored_df["institution"].iloc[0]
+                st.rerun()
+
+if draft_key is not None and f"import_base_{draft_key}" in st.session_state:
+    import_df = st.session_state[f"import_base_{draft_key}"]
 
     # --- 結果表示と保存 ---
-    if all_processed_rows:
-        import_df = pd.DataFrame(all_processed_rows).sort_values(by="date")
-        
-        st.write(f"### プレビュー (全 {len(uploaded_files)} ファイル分)")
+    if import_df is not None:
+        st.write(f"### プレビュー (全 {len(import_df)} 件)")
+
+        # レシート登録済み (Transaction_Log) との重複候補チェック
+        if target_sheet == "Credit_DB":
+            log_df = utils.load_typed_ledger(utils.LOG_SHEET_NAME)
+            dup_df = utils.find_cross_duplicates(import_df, log_df)
+            if not dup_df.empty:
+                st.warning(f"⚠️ レシート登録済みの可能性がある明細が {dup_df['new_index'].nunique()} 件あります")
+                view_dup = dup_df[["new_date", "new_store", "existing_date", "existing_store", "amount", "score"]].copy()
+                view_dup.columns = ["利用日(CSV)", "利用店名(CSV)", "日付(レシート)", "店名(レシート)", "金額", "類似度"]
+                st.dataframe(
+                    view_dup,
+                    column_config={
+                        "利用日(CSV)": st.column_config.DateColumn(format="YYYY-MM-DD"),
+                        "日付(レシート)": st.column_config.DateColumn(format="YYYY-MM-DD"),
+                        "金額": st.column_config.NumberColumn(format="%d円"),
+                        "類似度": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0, format="%.2f"),
+                    },
+                    hide_index=True,
+                    use_container_width=True
+                )
         
         edited_df = st.data_editor(
             import_df,
@@ -185,8 +127,9 @@ if uploaded_files:
                 "institution": st.column_config.TextColumn("金融機関", disabled=True),
                 "balance": st.column_config.NumberColumn("残高")
             },
-            hide_index=True, key="editor"
+            hide_index=True, key=f"editor_{draft_key}"
         )
+        utils.checkpoint_draft("csv", draft_key, edited_df)
         
         if st.button(f"✅ {target_sheet} に一括登録実行"):
             # ★修正: シンプルな戻り値受け取り
@@ -198,6 +141,7 @@ if uploaded_files:
                 if skipped_count > 0:
                     msg += f"- **{skipped_count}** 件は重複のためスキップされました"
                 st.success(msg)
+                utils.delete_draft("csv", draft_key)
 
                 # マスタ学習
                 new_mappings = {}
@@ -0,0 +1,82 @@
+import streamlit as st
+import pandas as pd
+import utils
+
+st.set_page_config(page_title="推移分析", layout="wide")
+utils.check_password()
+
+st.title("📈 長期推移分析")
+
+# データ更新ボタン
+refresh = st.button("データを更新")
+
+# データの読み込み (型変換済み・キャッシュがあれば即時復元)
+log_df = utils.load_typed_ledger(utils.LOG_SHEET_NAME, refresh=refresh)
+bank_df = utils.load_typed_ledger(utils.BANK_SHEET_NAME, refresh=refresh)
+credit_df = utils.load_typed_ledger(utils.CREDIT_SHEET_NAME, refresh=refresh)
+
+flow_df = utils.build_cashflow_frame(log_df, bank_df, credit_df)
+
+if flow_df.empty:
+    st.info("データが見つかりません。")
+    st.stop()
+
+expense_df = flow_df[flow_df["kind"] == "支出"]
+income_df = flow_df[flow_df["kind"] == "収入"]
+
+# --- 期間選択 ---
+min_month = flow_df["month"].min().to_timestamp().date()
+max_month = flow_df["month"].max().to_timestamp().date()
+col1, col2 = st.columns(2)
+start_date = col1.date_input("開始月", value=min_month, min_value=min_month, max_value=max_month)
+end_date = col2.date_input("終了月", value=max_month, min_value=min_month, max_value=max_month)
+
+def clip(data):
+    return data.loc[pd.Timestamp(start_date):pd.Timestamp(end_date) + pd.offsets.MonthEnd(0)]
+
+# 1. 収入・支出・資産の推移
+st.divider()
+st.write("### 💹 収入・支出・資産の推移 (会計月)")
+summary = pd.DataFrame({
+    "収入": utils.monthly_pivot(income_df, "kind").sum(axis=1),
+    "支出": utils.monthly_pivot(expense_df, "kind").sum(axis=1),
+}).fillna(0)
+balance = utils.daily_bank_balance(bank_df)
+if not balance.empty:
+    # 会計月ごとの月末残高 (25日締めに合わせて24日時点)
+    monthly_balance = balance.groupby(utils.get_fiscal_periods(balance.index.to_series())).last()
+    monthly_balance.index = monthly_balance.index.to_timestamp()
+    summary["資産"] = monthly_balance
+st.line_chart(clip(summary))
+
+# 2. 支出合計と移動平均
+st.write("### 📉 月次支出と移動平均 (3ヶ月 / 12ヶ月)")
+total_expense = summary["支出"].rename("支出")
+st.line_chart(clip(utils.add_rolling_averages(total_expense)))
+
+# 3. カテゴリ別・対象者別
+tab_cat, tab_mem = st.tabs(["🗂 カテゴリ別", "👤 対象者別"])
+with tab_cat:
+    cat_pivot = utils.monthly_pivot(expense_df, "category")
+    top_cats = cat_pivot.sum().sort_values(ascending=False).index.tolist()
+    selected_cats = st.multiselect("表示するカテゴリ", top_cats, default=top_cats[:8])
+    if selected_cats:
+        st.bar_chart(clip(cat_pivot[selected_cats]), stack=True)
+    show_rolling = st.checkbox("12ヶ月移動平均で表示", value=False)
+    if show_rolling and selected_cats:
+        st.line_chart(clip(cat_pivot[selected_cats].rolling(12, min_periods=1).mean()))
+
+with tab_mem:
+    mem_pivot = utils.monthly_pivot(expense_df, "member")
+    st.bar_chart(clip(mem_pivot), stack=True)
+    st.line_chart(clip(mem_pivot.rolling(3, min_periods=1).mean()))
+
+# 4. 日次の推移 (表示用に間引き)
+if not balance.empty:
+    st.write("### 🏦 口座残高の推移 (日次)")
+    st.line_chart(utils.downsample(clip(balance)))
+
+if not expense_df.empty:
+    st.write("### 🧾 日次支出")
+    daily_expense = expense_df.groupby("date")["amount"].sum().asfreq('D', fill_value=0)
+    st.bar_chart(utils.downsample(clip(daily_expense), how="sum"))
@@ -0,0 +1,154 @@
+import random
+import threading
+import time
+from collections import deque
+
+import gspread
+
+# --- Sheets API クォータ設定 ---
+# Google Sheets API の既定クォータ: ユーザーあたり 読み取り60回/分・書き込み60回/分
+READ_QUOTA_PER_MINUTE = 60
+WRITE_QUOTA_PER_MINUTE = 60
+
+WINDOW_SEC = 60.0
+
+# 再試行の待機合計がクォータの1分窓を超えるように設定する
+# (equal jitter: 各回 delay/2〜delay 待機 → 最低でも約63秒)
+MAX_RETRIES = 7
+BACKOFF_BASE_SEC = 2.0
+BACKOFF_MAX_SEC = 32.0
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """直近60秒間の呼び出し回数を上限以下に保つスライディングウィンドウ (スレッドセーフ)"""
+
+    def __init__(self, per_minute):
+        self.limit = per_minute
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.calls and self.calls[0] <= now - WINDOW_SEC:
+            self.calls.popleft()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._expire(now)
+                if len(self.calls) < self.limit:
+                    self.calls.append(now)
+                    return
+                wait = self.calls[0] + WINDOW_SEC - now
+            time.sleep(max(wait, 0.01))
+
+    def drain(self):
+        # 429を受けたら窓を埋め、他スレッドも含めて次の枠が空くまで待たせる
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            while len(self.calls) < self.limit:
+                self.calls.append(now)
+
+
+read_limiter = RateLimiter(READ_QUOTA_PER_MINUTE)
+write_limiter = RateLimiter(WRITE_QUOTA_PER_MINUTE)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _status_code(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _call_with_retry(limiter, func, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = _status_code(e)
+            if status not in RETRYABLE_STATUS or attempt == MAX_RETRIES:
+                raise
+            if status == 429:
+                limiter.drain()
+            # Equal jitter: 待機時間に幅を持たせて再試行の集中を避ける
+            delay = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * (2 ** attempt))
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+
+def sheets_read(func, *args, coalesce_key=None, **kwargs):
+    """読み取り系のgspread呼び出し。同一キーの同時呼び出しは1回にまとめる"""
+    if coalesce_key is None:
+        return _call_with_retry(read_limiter, func, *args, **kwargs)
+
+    with _inflight_lock:
+        entry = _inflight.get(coalesce_key)
+        owner = entry is None
+        if owner:
+            entry = {"done": threading.Event(), "result": None, "error": None}
+            _inflight[coalesce_key] = entry
+
+    if not owner:
+        entry["done"].wait()
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["result"]
+
+    try:
+        entry["result"] = _call_with_retry(read_limiter, func, *args, **kwargs)
+        return entry["result"]
+    except Exception as e:
+        entry["error"] = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(coalesce_key, None)
+        entry["done"].set()
+
+
+def sheets_write(func, *args, **kwargs):
+    """書き込み系のgspread呼び出し (書き込み用クォータで制御)"""
+    return _call_with_retry(write_limiter, func, *args, **kwargs)
+
+
+def open_worksheet(client, spreadsheet_id, sheet_name=None):
+    """スプレッドシートを開きワークシートを返す。sheet_name省略時は先頭シート"""
+    spreadsheet = sheets_read(client.open_by_key, spreadsheet_id,
+                              coalesce_key=("open", spreadsheet_id))
+    if sheet_name is None:
+        return sheets_read(lambda: spreadsheet.sheet1,
+                           coalesce_key=("sheet1", spreadsheet_id))
+    return sheets_read(spreadsheet.worksheet, sheet_name,
+                       coalesce_key=("worksheet", spreadsheet_id, sheet_name))
+
+
+def open_or_create_worksheet(client, spreadsheet_id, sheet_name, header):
+    """ワークシートを開く。存在しなければヘッダー行付きで作成する"""
+    try:
+        return open_worksheet(client, spreadsheet_id, sheet_name)
+    except gspread.WorksheetNotFound:
+        spreadsheet = sheets_read(client.open_by_key, spreadsheet_id,
+                                  coalesce_key=("open", spreadsheet_id))
+        sheet = sheets_write(spreadsheet.add_worksheet, title=sheet_name, rows=1000, cols=len(header))
+        sheets_write(sheet.append_row, header)
+        return sheet
+
+
+def get_all_values(sheet):
+    return sheets_read(sheet.get_all_values, coalesce_key=("values", sheet.id, sheet.title))
+
+
+def append_row(sheet, row):
+    return sheets_write(sheet.append_row, row)
+
+
+def append_rows(sheet, rows):
+    return sheets_write(sheet.append_rows, rows)
+
+
+def batch_update(sheet, data):
+    return sheets_write(sheet.batch_update, data)
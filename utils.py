@@ -2,14 +2,23 @@ import streamlit as st
 import pandas as pd
 import json
 import base64
-import re
-import io
-import unicodedata
 from openai import OpenAI
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 import traceback
+import os
+import time
+import uuid
+import hashlib
+import sheets_limiter as sl
+from ledger_core import (
+    JST, MASTER_SHEET_NAME, INSTITUTION_CONFIG,
+    authorize_client,
+    read_category_master, normalize_text, suggest_category,
+    parse_institution_csv, plan_bulk_rows, find_cross_duplicates,
+    LEDGER_CACHE_MAX_AGE_MINUTES,
+    ledger_cache_path, is_ledger_cache_fresh, invalidate_ledger_cache,
+)
 
 # --- 定数定義 ---
 CATEGORIES = [
@@ -21,31 +30,34 @@ CATEGORIES = [
     "その他", "資産"
 ]
 MEMBERS = ["マサ", "ユウ", "ハル", "共通"]
-JST = timezone(timedelta(hours=9), 'JST')
 
 LOG_SHEET_NAME = "Transaction_Log"
-MASTER_SHEET_NAME = "Category_Master" 
-
-# --- 金融機関ごとの設定 ---
-# 文字コードは cp932 (Windows Shift-JIS) に統一
-INSTITUTION_CONFIG = {
-    "M銀行": { 
-        "sheet_name": "Bank_DB", "encoding": "cp932",
-        "date_col": "年月日", "store_col": "お取り扱い内容", 
-        "expense_col": "お引出し", "income_col": "お預入れ", "balance_col": "残高"
-    },
-    "Rカード": { 
-        "sheet_name": "Credit_DB", "encoding": "cp932",
-        "date_col": "利用日", "store_col": "利用店名・商品名", 
-        "amount_col": "支払総額", "member_col": "利用者"
-    },
-    "R証券": {
-        "sheet_name": "Securities_DB", "encoding": "cp932",
-        "custom_loader": "rakuten_sec_balance" 
-    },
-    "Y銀行": { "sheet_name": "Bank_DB", "date_col": "取引日", "store_col": "お取引内容", "amount_col": "出金金額", "encoding": "cp932" },
-    "Iクレ": { "sheet_name": "Credit_DB", "date_col": "利用日", "store_col": "加盟店名", "amount_col": "利用金額", "encoding": "cp932" }
-}
+ITEM_MASTER_SHEET_NAME = "Item_Master"
+ITEM_MASTER_HEADER = ["商品名", "カテゴリ"]
+
+# --- 台帳の列定義・キャッシュ ---
+LOG_COLUMNS = ["date", "store", "category", "amount", "timestamp", "member"]
+DB_COLUMNS = ["date", "store", "category_1", "category_2", "amount", "timestamp", "member", "institution", "balance"]
+CATEGORY_DTYPE_COLUMNS = ["category", "category_1", "category_2", "member", "institution"]
+DEFAULT_ITEM_CATEGORY = "食費"
+
+# --- 推移分析 ---
+BANK_SHEET_NAME = "Bank_DB"
+CREDIT_SHEET_NAME = "Credit_DB"
+# 口座引き落としのうちカード明細と二重計上になる費目
+CARD_SETTLEMENT_CATEGORIES = ["Rカード", "Mカード", "イオンカード"]
+# 口座間・投資への振替や立替は資産の移動なので、収入・支出のどちらにも計上しない
+TRANSFER_CATEGORIES = [
+    "投資振替", "はると振替", "立替", "投資", "投資信託",
+    "米国株式", "国内株式", "外国株式", "債券", "資産",
+]
+TREND_MAX_POINTS = 400
+# レシート登録 (Transaction_Log) で収入として扱う費目
+INCOME_CATEGORIES = ["給料", "賞与", "手当"]
+
+# --- 編集中データの下書き保存 ---
+DRAFT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".drafts")
+DRAFT_MAX_AGE_HOURS = 24
 
 def check_password():
     if "APP_PASSWORD" not in st.secrets:
@@ -66,89 +78,34 @@ def check_password():
     st.stop()
 
 def get_gspread_client():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds_dict = dict(st.secrets["gcp_service_account"])
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    return gspread.authorize(creds)
-
-# --- 特殊CSV読み込み機能 ---
-
-def extract_date_from_filename(filename):
-    if not filename: return None
-    match = re.search(r'(\d{8})', filename)
-    if match:
-        try:
-            return datetime.strptime(match.group(1), '%Y%m%d').date()
-        except:
-            return None
-    return None
-
-def load_rakuten_securities_csv(file_obj, encoding="cp932"):
-    try:
-        content = file_obj.getvalue().decode(encoding)
-        lines = content.splitlines()
-        start_row = 0
-        found = False
-        for i, line in enumerate(lines):
-            if "■ 保有商品詳細" in line:
-                start_row = i + 2
-                found = True
-                break
-        if not found: start_row = 0
-        csv_io = io.StringIO("\n".join(lines[start_row:]))
-        df = pd.read_csv(csv_io)
-        return df
-    except Exception as e:
-        print(f"Read Error: {e}")
-        return None
+    return authorize_client(st.secrets["gcp_service_account"])
 
 # --- カテゴリマスタ機能 ---
 
 def load_category_master():
-    client = get_gspread_client()
-    try:
-        sheet = client.open_by_key(st.secrets["SPREADSHEET_ID"]).worksheet(MASTER_SHEET_NAME)
-        data = sheet.get_all_values()
-        if len(data) <= 1: return {}
-        return {row[0]: row[1] for row in data[1:] if row[0]}
-    except:
-        return {}
-
-def normalize_text(text):
-    if not isinstance(text, str): return str(text)
-    normalized = unicodedata.normalize('NFKC', text)
-    return normalized.replace(" ", "").replace("　", "")
-
-def suggest_category(store_name, master_dict):
-    if not store_name: return "未分類"
-    target_store = normalize_text(store_name)
-    for keyword, category in master_dict.items():
-        if normalize_text(keyword) in target_store:
-            return category
-    return "未分類"
+    return read_category_master(get_gspread_client(), st.secrets["SPREADSHEET_ID"])
 
 def update_category_master(new_mappings):
     if not new_mappings: return 0
     client = get_gspread_client()
-    sheet = client.open_by_key(st.secrets["SPREADSHEET_ID"]).worksheet(MASTER_SHEET_NAME)
+    sheet = sl.open_worksheet(client, st.secrets["SPREADSHEET_ID"], MASTER_SHEET_NAME)
     current_master = load_category_master()
     rows_to_add = []
     for kw, cat in new_mappings.items():
         if kw and kw not in current_master:
             rows_to_add.append([kw, cat])
     if rows_to_add:
-        sheet.append_rows(rows_to_add)
+        sl.append_rows(sheet, rows_to_add)
         return len(rows_to_add)
     return 0
 
 def create_master_from_history():
     client = get_gspread_client()
-    spreadsheet = client.open_by_key(st.secrets["SPREADSHEET_ID"])
     history_mappings = {}
     target_config = {"name": "Bank_DB", "store_idx": 1, "cat_idx": 3}
     try:
-        sheet = spreadsheet.worksheet(target_config["name"])
-        data = sheet.get_all_values()
+        sheet = sl.open_worksheet(client, st.secrets["SPREADSHEET_ID"], target_config["name"])
+        data = sl.get_all_values(sheet)
         if len(data) > 1:
             for row in data[1:]:
                 if len(row) > max(target_config["store_idx"], target_config["cat_idx"]):
@@ -160,6 +117,102 @@ def create_master_from_history():
         return 0
     return update_category_master(history_mappings)
 
+# --- 商品名マスタ (分割モード用) ---
+
+def load_item_master():
+    client = get_gspread_client()
+    try:
+        sheet = sl.open_worksheet(client, st.secrets["SPREADSHEET_ID"], ITEM_MASTER_SHEET_NAME)
+        data = sl.get_all_values(sheet)
+        if len(data) <= 1: return {}
+        return {normalize_text(row[0]): row[1] for row in data[1:] if len(row) > 1 and row[0]}
+    except:
+        return {}
+
+def update_item_master(new_mappings):
+    """確定したカテゴリを商品名マスタに反映する。既存の商品名はカテゴリが異なれば上書きする"""
+    if not new_mappings: return 0
+    try:
+        client = get_gspread_client()
+        sheet = sl.open_or_create_worksheet(
+            client, st.secrets["SPREADSHEET_ID"], ITEM_MASTER_SHEET_NAME, ITEM_MASTER_HEADER
+        )
+        data = sl.get_all_values(sheet)
+        # 正規化した商品名 -> (シート上の行番号, カテゴリ)
+        current_master = {
+            normalize_text(row[0]): (row_no, row[1] if len(row) > 1 else "")
+            for row_no, row in enumerate(data[1:], start=2) if row and row[0]
+        }
+        rows_to_add = []
+        cells_to_update = []
+        for name, cat in new_mappings.items():
+            key = normalize_text(name)
+            if not key or cat not in CATEGORIES: continue
+            if key not in current_master:
+                rows_to_add.append([key, cat])
+                current_master[key] = (None, cat)
+            elif current_master[key][1] != cat:
+                row_no = current_master[key][0]
+                if row_no: cells_to_update.append({"range": f"B{row_no}", "values": [[cat]]})
+                current_master[key] = (row_no, cat)
+        if cells_to_update:
+            sl.batch_update(sheet, cells_to_update)
+        if rows_to_add:
+            sl.append_rows(sheet, rows_to_add)
+        return len(rows_to_add) + len(cells_to_update)
+    except Exception as e:
+        print(f"Item Master Error: {e}")
+        return 0
+
+def categorize_items_locally(item_names, master_dict, item_master):
+    """商品名をローカルで分類する。戻り値: ({商品名: カテゴリ}, 未分類の商品名リスト)"""
+    resolved = {}
+    unresolved = []
+    for name in item_names:
+        if not name or name in resolved or name in unresolved: continue
+        cat = item_master.get(normalize_text(name))
+        if not cat:
+            cat = suggest_category(name, master_dict)
+        if cat in CATEGORIES:
+            resolved[name] = cat
+        else:
+            unresolved.append(name)
+    return resolved, unresolved
+
+def classify_item_names(item_names):
+    """ローカルで分類できなかった商品名だけをテキストのみで一括分類する"""
+    if not item_names: return {}
+    client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+    categories_str = "/".join(CATEGORIES)
+    system_prompt = f"商品名を分類。JSON出力。{{商品名: category}}。categoryは({categories_str})から選択。"
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": "\n".join(item_names)}
+            ],
+            response_format={"type": "json_object"}
+        )
+        content = response.choices[0].message.content
+        if not content: return {}
+        result = json.loads(content)
+        return {name: cat for name, cat in result.items() if name in item_names and cat in CATEGORIES}
+    except Exception as e:
+        print(f"Classify Error: {e}")
+        return {}
+
+def categorize_receipt_items(items, master_dict=None, item_master=None):
+    """明細ごとのカテゴリを返す。ローカル(カテゴリマスタ・商品名マスタ)優先、残りのみAIに問い合わせる"""
+    if master_dict is None: master_dict = load_category_master()
+    if item_master is None: item_master = load_item_master()
+    names = [str(item.get("name", "")).strip() for item in items]
+    resolved, unresolved = categorize_items_locally(names, master_dict, item_master)
+    if unresolved:
+        # AIの推測はここでは保存しない (登録時にユーザーが確定したカテゴリのみ学習する)
+        resolved.update(classify_item_names(unresolved))
+    return [resolved.get(name, DEFAULT_ITEM_CATEGORY) for name in names]
+
 # --- 既存の解析・保存ロジック ---
 
 def analyze_receipt(image_bytes, mode="total"):
@@ -167,7 +220,7 @@ def analyze_receipt(image_bytes, mode="total"):
     client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
     categories_str = "/".join(CATEGORIES)
     if mode == "split":
-        system_prompt = f"レシート解析。JSON出力。1. date, store. 2. items(name, amount). カテゴリ推測。"
+        system_prompt = "レシート解析。JSON出力。1. date, store. 2. items(name, amount)。"
     else:
         system_prompt = f"レシート解析。JSON出力。date, store, amount, category({categories_str})。"
     try:
@@ -190,12 +243,13 @@ def save_to_google_sheets(data):
     try:
         spreadsheet_id = st.secrets["SPREADSHEET_ID"]
         try:
-            sheet = client.open_by_key(spreadsheet_id).worksheet(LOG_SHEET_NAME)
-        except:
-            sheet = client.open_by_key(spreadsheet_id).sheet1
+            sheet = sl.open_worksheet(client, spreadsheet_id, LOG_SHEET_NAME)
+        except gspread.WorksheetNotFound:
+            sheet = sl.open_worksheet(client, spreadsheet_id)
         now_jst = datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')
         row = [str(data['date']), data['store'], data['category'], data['amount'], now_jst, data['member']]
-        sheet.append_row(row)
+        sl.append_row(sheet, row)
+        invalidate_ledger_cache(LOG_SHEET_NAME)
         return True
     except Exception as e:
         st.error(f"保存エラー: {e}")
@@ -207,55 +261,18 @@ def save_bulk_to_google_sheets(df_to_save, target_sheet_name, institution_name):
     try:
         spreadsheet_id = st.secrets["SPREADSHEET_ID"]
         try:
-            sheet = client.open_by_key(spreadsheet_id).worksheet(target_sheet_name)
+            sheet = sl.open_worksheet(client, spreadsheet_id, target_sheet_name)
         except gspread.WorksheetNotFound:
             st.error(f"エラー: シート '{target_sheet_name}' が見つかりません。")
             return False, "Sheet not found", 0
 
-        existing_data = sheet.get_all_values()
-        existing_signatures = set()
-
-        if len(existing_data) > 1:
-            for row in existing_data[1:]:
-                if len(row) < 7: continue 
-                amount_clean = str(row[4]).replace(',', '').replace('円', '')
-                inst_val = str(row[7]) if len(row) > 7 else ""
-                balance_val = str(row[8]) if len(row) > 8 else ""
-                balance_clean = balance_val.replace(',', '').replace('円', '')
-                signature = (
-                    str(row[0]), str(row[1]), str(row[2]), 
-                    amount_clean, str(row[6]), inst_val, balance_clean
-                )
-                existing_signatures.add(signature)
-
+        existing_data = sl.get_all_values(sheet)
         now_jst = datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')
-        rows_to_append = []
-        skipped_count = 0
+        rows_to_append, skipped_count = plan_bulk_rows(df_to_save, existing_data, institution_name, now_jst)
 
-        for _, row in df_to_save.iterrows():
-            raw_bal = row.get('balance', '')
-            bal_str = str(raw_bal).replace(',', '').replace('円', '').replace('nan', '').replace('None', '')
-            try:
-                if bal_str: bal_str = str(int(float(bal_str)))
-            except: pass
-
-            new_signature = (
-                str(row['date']), str(row['store']), str(row['category_1']), 
-                str(row['amount']), str(row['member']), str(institution_name), bal_str
-            )
-
-            if new_signature not in existing_signatures:
-                rows_to_append.append([
-                    str(row['date']), str(row['store']), str(row['category_1']), 
-                    str(row['category_2']), int(row['amount']), now_jst, 
-                    str(row['member']), str(institution_name), bal_str
-                ])
-                existing_signatures.add(new_signature)
-            else:
-                skipped_count += 1
-            
         if rows_to_append:
-            sheet.append_rows(rows_to_append)
+            sl.append_rows(sheet, rows_to_append)
+            invalidate_ledger_cache(target_sheet_name)
             return True, len(rows_to_append), skipped_count
         else:
             return True, 0, skipped_count
@@ -268,10 +285,10 @@ def load_data_from_sheets():
     try:
         spreadsheet_id = st.secrets["SPREADSHEET_ID"]
         try:
-            sheet = client.open_by_key(spreadsheet_id).worksheet(LOG_SHEET_NAME)
-        except:
-            sheet = client.open_by_key(spreadsheet_id).sheet1
-        data = sheet.get_all_values()
+            sheet = sl.open_worksheet(client, spreadsheet_id, LOG_SHEET_NAME)
+        except gspread.WorksheetNotFound:
+            sheet = sl.open_worksheet(client, spreadsheet_id)
+        data = sl.get_all_values(sheet)
         if len(data) <= 1: return pd.DataFrame()
         df = pd.DataFrame(data[1:])
         if df.shape[1] >= 6:
@@ -284,7 +301,293 @@ def load_data_from_sheets():
         st.error(f"読み込みエラー: {e}")
         return None
 
-def get_fiscal_month(date_obj):
-    if date_obj.day >= 25:
-        return (date_obj.replace(day=1) + pd.DateOffset(months=1)).strftime('%Y-%m')
-    return date_obj.strftime('%Y-%m')
\ No newline at end of file
+def get_fiscal_periods(dates):
+    """datetime64のSeriesを会計月 (25日締め) の月次Periodに変換する"""
+    periods = dates.dt.to_period('M')
+    return periods.where(dates.dt.day < 25, periods + 1)
+
+def get_fiscal_months(dates):
+    """会計月 (25日締め) を 'YYYY-MM' 文字列で返す。datetime64のSeriesを受け取る"""
+    return get_fiscal_periods(dates).astype(str)
+
+# --- 型付き台帳ローダー ---
+
+def load_db_from_sheets(sheet_name):
+    """Bank_DB / Credit_DB などの9列形式シートを読み込む (値は文字列のまま)"""
+    client = get_gspread_client()
+    try:
+        sheet = sl.open_worksheet(client, st.secrets["SPREADSHEET_ID"], sheet_name)
+        data = sl.get_all_values(sheet)
+        if len(data) <= 1: return pd.DataFrame(columns=DB_COLUMNS)
+        df = pd.DataFrame(data[1:]).reindex(columns=range(len(DB_COLUMNS)))
+        df.columns = DB_COLUMNS
+        return df
+    except Exception as e:
+        st.error(f"読み込みエラー ({sheet_name}): {e}")
+        return None
+
+def _to_number(series):
+    cleaned = series.astype(str).str.replace(',', '', regex=False).str.replace('円', '', regex=False)
+    return pd.to_numeric(cleaned, errors='coerce')
+
+def _to_compact_int(values):
+    values = values.fillna(0).round()
+    if values.empty or (values.abs().max() < 2**31):
+        return values.astype('int32')
+    return values.astype('int64')
+
+def to_typed_ledger(df):
+    """文字列のみのDataFrameを、日付・金額・カテゴリ列を型付けした省メモリ形式に変換する"""
+    typed = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        if col in ("date", "timestamp"):
+            typed[col] = pd.to_datetime(df[col], errors='coerce')
+        elif col == "amount":
+            typed[col] = _to_compact_int(_to_number(df[col]))
+        elif col == "balance":
+            typed[col] = _to_number(df[col]).round().astype('Int64')
+        elif col in CATEGORY_DTYPE_COLUMNS:
+            typed[col] = df[col].fillna("").astype(str).str.strip().astype('category')
+        else:
+            typed[col] = df[col].fillna("").astype(str)
+    return typed
+
+def save_ledger_parquet(df, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    df.to_parquet(path, index=False)
+
+def load_ledger_parquet(path):
+    return pd.read_parquet(path)
+
+def load_typed_ledger(sheet_name=LOG_SHEET_NAME, use_cache=True, refresh=False):
+    """型付き台帳を返す。有効期限内のParquetキャッシュがあればシートを読まずに復元する"""
+    cache_path = ledger_cache_path(sheet_name)
+    max_age = float(st.secrets.get("LEDGER_CACHE_MAX_AGE_MINUTES", LEDGER_CACHE_MAX_AGE_MINUTES))
+    if use_cache and not refresh and is_ledger_cache_fresh(sheet_name, max_age):
+        try:
+            return load_ledger_parquet(cache_path)
+        except Exception as e:
+            print(f"Cache Read Error: {e}")
+
+    if sheet_name == LOG_SHEET_NAME:
+        raw = load_data_from_sheets()
+    else:
+        raw = load_db_from_sheets(sheet_name)
+    if raw is None: return None
+    if raw.empty: return raw
+
+    typed = to_typed_ledger(raw)
+    if use_cache:
+        try:
+            save_ledger_parquet(typed, cache_path)
+        except Exception as e:
+            print(f"Cache Write Error: {e}")
+    return typed
+
+# --- 推移分析 ---
+
+def build_cashflow_frame(log_df, bank_df, credit_df):
+    """3シートを date, kind(収入/支出), category, member, amount, source の共通形式にまとめる
+
+    カードで支払ったレシートは Credit_DB の明細と同じ支出なので、
+    find_cross_duplicates で一致した Transaction_Log の行は除外し、カード明細側を計上する。
+    TRANSFER_CATEGORIES の行は振替なので全シートで除外する。
+    """
+    frames = []
+    if log_df is not None and not log_df.empty:
+        if credit_df is not None and not credit_df.empty:
+            card_expense = credit_df[credit_df["category_1"] == "支出"]
+            dup_df = find_cross_duplicates(card_expense, log_df)
+            if not dup_df.empty:
+                matched_rows = set(dup_df["existing_rows"].explode())
+                log_df = log_df[~log_df.index.isin(matched_rows)]
+        log_category = log_df["category"].astype(str)
+        frames.append(pd.DataFrame({
+            "date": log_df["date"],
+            "kind": log_category.isin(INCOME_CATEGORIES).map({True: "収入", False: "支出"}),
+            "category": log_category,
+            "member": log_df["member"].astype(str),
+            "amount": log_df["amount"], "source": LOG_SHEET_NAME,
+        }))
+    for sheet_name, df in ((BANK_SHEET_NAME, bank_df), (CREDIT_SHEET_NAME, credit_df)):
+        if df is None or df.empty: continue
+        df = df[df["category_1"].isin(["支出", "収入"])]
+        if sheet_name == BANK_SHEET_NAME:
+            df = df[~df["category_2"].isin(CARD_SETTLEMENT_CATEGORIES)]
+        frames.append(pd.DataFrame({
+            "date": df["date"], "kind": df["category_1"].astype(str),
+            "category": df["category_2"].astype(str),
+            "member": df["member"].astype(str),
+            "amount": df["amount"], "source": sheet_name,
+        }))
+    if not frames:
+        return pd.DataFrame(columns=["date", "kind", "category", "member", "amount", "source"])
+
+    flow = pd.concat(frames, ignore_index=True).dropna(subset=["date"])
+    flow = flow[~flow["category"].isin(TRANSFER_CATEGORIES)]
+    flow["member"] = flow["member"].replace("", "共通")
+    for col in ("kind", "category", "member", "source"):
+        flow[col] = flow[col].astype('category')
+    flow["amount"] = flow["amount"].astype('int64')
+    flow["month"] = get_fiscal_periods(flow["date"])
+    return flow
+
+def monthly_pivot(flow_df, by):
+    """会計月×by列の金額合計。欠けている月は0で埋め、月初日付のインデックスで返す"""
+    if flow_df.empty: return pd.DataFrame()
+    pivot = flow_df.groupby(["month", by], observed=True)["amount"].sum().unstack(by, fill_value=0)
+    full_range = pd.period_range(pivot.index.min(), pivot.index.max(), freq='M')
+    pivot = pivot.reindex(full_range, fill_value=0)
+    pivot.index = pivot.index.to_timestamp()
+    return pivot
+
+def add_rolling_averages(series, windows=(3, 12)):
+    result = pd.DataFrame({series.name or "amount": series})
+    for w in windows:
+        result[f"{w}ヶ月平均"] = series.rolling(w, min_periods=1).mean()
+    return result
+
+def daily_bank_balance(bank_df):
+    """金融機関ごとの日次残高を前方補完して合算する"""
+    if bank_df is None or bank_df.empty or "balance" not in bank_df.columns:
+        return pd.Series(dtype='float64')
+    df = bank_df.dropna(subset=["date", "balance"])
+    if df.empty: return pd.Series(dtype='float64')
+    df = df.sort_values(["date", "timestamp"])
+    per_inst = df.groupby(["date", "institution"], observed=True)["balance"].last().unstack("institution")
+    per_inst = per_inst.astype('float64').resample('D').last().ffill()
+    return per_inst.sum(axis=1).rename("資産残高")
+
+def downsample(data, max_points=TREND_MAX_POINTS, how="last"):
+    """日付インデックスの系列を、表示用に最大 max_points 点程度へ間引く"""
+    if len(data) <= max_points: return data
+    span_days = (data.index.max() - data.index.min()).days + 1
+    step = -(-span_days // max_points)
+    return data.resample(f"{step}D").agg(how).dropna(how="all")
+
+# --- 下書き保存 (編集中データの一時保存) ---
+
+def get_draft_user():
+    """この環境 (インストール) 単位の利用者ID。ページ移動・再読み込み・再起動でも変わらない"""
+    id_path = os.path.join(DRAFT_DIR, "install_id")
+    try:
+        with open(id_path, encoding="utf-8") as f:
+            uid = f.read().strip()
+        if uid.isalnum(): return uid
+    except OSError:
+        pass
+    uid = uuid.uuid4().hex[:12]
+    os.makedirs(DRAFT_DIR, exist_ok=True)
+    with open(id_path, "w", encoding="utf-8") as f:
+        f.write(uid)
+    return uid
+
+def draft_key(*parts):
+    """アップロード内容などから下書きのキーを作る"""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+def _draft_user_dir():
+    return os.path.join(DRAFT_DIR, get_draft_user())
+
+def _draft_path(kind, key):
+    return os.path.join(_draft_user_dir(), f"{kind}_{key}.pkl.gz")
+
+def _draft_max_age_sec():
+    return float(st.secrets.get("DRAFT_MAX_AGE_HOURS", DRAFT_MAX_AGE_HOURS)) * 3600
+
+def purge_expired_drafts():
+    if not os.path.isdir(DRAFT_DIR): return 0
+    limit = time.time() - _draft_max_age_sec()
+    removed = 0
+    for root, _, files in os.walk(DRAFT_DIR):
+        for name in files:
+            if not name.endswith(".pkl.gz"): continue
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+def save_draft(kind, key, df, label=""):
+    path = _draft_path(kind, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pd.to_pickle({"label": label, "data": df}, path)
+    except Exception as e:
+        print(f"Draft Save Error: {e}")
+
+def _read_draft(path):
+    try:
+        draft = pd.read_pickle(path)
+        # 表示名なしで保存された旧形式 (DataFrameのみ) にも対応する
+        if isinstance(draft, pd.DataFrame): return {"label": "", "data": draft}
+        return draft
+    except Exception as e:
+        print(f"Draft Read Error: {e}")
+        return None
+
+def load_draft(kind, key):
+    purge_expired_drafts()
+    path = _draft_path(kind, key)
+    if not os.path.exists(path): return None
+    draft = _read_draft(path)
+    return draft["data"] if draft else None
+
+def list_drafts(kind):
+    """保存済みの下書きを新しい順に返す (アップロード前の復元候補の表示用)"""
+    purge_expired_drafts()
+    user_dir = _draft_user_dir()
+    if not os.path.isdir(user_dir): return []
+    prefix = f"{kind}_"
+    drafts = []
+    for name in os.listdir(user_dir):
+        if not (name.startswith(prefix) and name.endswith(".pkl.gz")): continue
+        path = os.path.join(user_dir, name)
+        draft = _read_draft(path)
+        if not draft: continue
+        drafts.append({
+            "key": name[len(prefix):-len(".pkl.gz")],
+            "label": draft.get("label", ""),
+            "rows": len(draft["data"]),
+            "saved_at": datetime.fromtimestamp(os.path.getmtime(path), JST),
+        })
+    return sorted(drafts, key=lambda d: d["saved_at"], reverse=True)
+
+def delete_draft(kind, key):
+    path = _draft_path(kind, key)
+    if os.path.exists(path):
+        os.remove(path)
+
+def checkpoint_draft(kind, key, edited_df, label=None):
+    """data_editor の編集結果が前回保存時から変わっていれば下書きを更新する (label省略時は既存の表示名を引き継ぐ)"""
+    state_key = f"_draft_saved_{kind}_{key}"
+    previous = st.session_state.get(state_key)
+    if previous is not None and previous.equals(edited_df): return
+    if label is None:
+        path = _draft_path(kind, key)
+        draft = _read_draft(path) if os.path.exists(path) else None
+        label = draft.get("label", "") if draft else ""
+    save_draft(kind, key, edited_df, label)
+    st.session_state[state_key] = edited_df.copy()
+
+def draft_restore_picker(kind):
+    """保存済みの下書き一覧を表示し、「復元」が押されたらその下書きのキーを返す"""
+    drafts = list_drafts(kind)
+    if not drafts: return None
+    st.write("### 💾 保存済みの下書き")
+    options = {
+        f"{d['saved_at']:%m/%d %H:%M} - {d['label'] or '(名称なし)'} ({d['rows']} 件)": d["key"]
+        for d in drafts
+    }
+    col1, col2 = st.columns([4, 1])
+    selected = col1.selectbox("復元する下書き", list(options.keys()), key=f"draft_pick_{kind}")
+    if col2.button("下書きを復元", key=f"draft_restore_{kind}"):
+        return options[selected]
+    return None